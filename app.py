@@ -6,53 +6,440 @@ Supports direct streams (MP4), HLS (.m3u8), and quality/audio detection.
 
 from flask import Flask, request, Response, render_template, abort, jsonify
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from urllib.parse import urlparse, urljoin
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 import json
 import subprocess
 import os
 import re
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 try:
-    import m3u8
+    import diskcache
 except ImportError:
-    m3u8 = None
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('stream.log'),
-        logging.StreamHandler()
-    ]
-)
+    diskcache = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import cachetools
+except ImportError:
+    cachetools = None
+try:
+    import httpx
+    import h2  # noqa: F401 -- required by httpx for http2=True
+except ImportError:
+    httpx = None
+
+# Configure logging: request threads only enqueue records; a background
+# listener thread does the file/console writes
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_handlers = [logging.FileHandler('stream.log'), logging.StreamHandler()]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_queue_handler = QueueHandler(queue.Queue(-1))
+_log_listener = None
+_log_listener_pid = None
+
+
+def _start_log_listener():
+    """
+    Start this process's background log writer. Threads don't survive
+    fork(), so forked children (e.g. gunicorn --preload workers) get a
+    fresh queue and listener instead of inheriting a dead one.
+    """
+    global _log_listener, _log_listener_pid
+    if _log_listener_pid == os.getpid():
+        return
+    _queue_handler.queue = queue.Queue(-1)
+    _log_listener = QueueListener(_queue_handler.queue, *_log_handlers)
+    _log_listener.start()
+    _log_listener_pid = os.getpid()
+    atexit.register(_log_listener.stop)
+
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+
+# The queue handler only renders the message; the listener's handlers add
+# timestamp/level via _log_formatter
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[_queue_handler])
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 
 # Configuration
-CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 1024 * 1024))  # 1MB chunks by default
 REQUEST_TIMEOUT = (5, 30)  # (connect, read) in seconds
 MAX_FILE_SIZE = 10 * 1024 * 1024 * 1024  # 10GB limit
+UPSTREAM_RCVBUF_BYTES = int(os.environ.get('UPSTREAM_RCVBUF_BYTES', 0))  # 0 = kernel autotuning
+MAX_RESPONSE_BYTES = 8 * 1024 * 1024  # cap for open-ended Range responses
+PLAYLIST_CACHE_TTL = 30  # seconds a master/VOD playlist is served from memory
+FFPROBE_CACHE_SIZE = 512  # ffprobe results kept in memory when diskcache is missing
+FFPROBE_CACHE_DIR = os.environ.get('FFPROBE_CACHE_DIR', '/var/cache/stream-proxy/ffprobe')
+FFPROBE_CACHE_TTL = 24 * 60 * 60  # seconds a cached ffprobe result stays valid
+PREFETCH_SEGMENTS = 4  # HLS segments fetched ahead when a playlist is served
+SEGMENT_CACHE_BYTES = int(os.environ.get('SEGMENT_CACHE_MB', 256)) * 1024 * 1024  # per worker process
+PREFETCH_MAX_SEGMENT_BYTES = 32 * 1024 * 1024  # larger segments are not prefetched
+
+
+class _TunedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter for upstream sockets: keeps urllib3's TCP_NODELAY and, only
+    if UPSTREAM_RCVBUF_BYTES is set, a fixed receive buffer. Leaving it unset
+    keeps the kernel's receive-window autotuning, which usually does better.
+    """
+    
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = list(HTTPConnection.default_socket_options)
+        if UPSTREAM_RCVBUF_BYTES:
+            socket_options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, UPSTREAM_RCVBUF_BYTES))
+        kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+# Shared upstream session: keeps TCP/TLS connections alive between requests,
+# so consecutive HLS segments from the same origin skip the handshake.
+# Created lazily so every gunicorn worker builds its own pool after fork.
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    """Return this process's pooled upstream session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = _TunedHTTPAdapter(
+                    pool_connections=32,
+                    pool_maxsize=256,
+                    max_retries=Retry(
+                        total=2,
+                        backoff_factor=0.1,
+                        status_forcelist=(502, 503, 504),
+                        raise_on_status=False,
+                    ),
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+# HTTP/2 client for segment prefetches: parallel fetches to one origin share
+# a single multiplexed connection instead of one HTTP/1.1 connection each
+_h2_client = None
+_h2_client_lock = threading.Lock()
+
+
+def _get_h2_client():
+    """Return this process's HTTP/2 client, or None when httpx[http2] isn't installed."""
+    global _h2_client
+    if httpx is None:
+        return None
+    if _h2_client is None:
+        with _h2_client_lock:
+            if _h2_client is None:
+                _h2_client = httpx.Client(
+                    http2=True,
+                    follow_redirects=True,
+                    timeout=httpx.Timeout(REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0]),
+                    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+                )
+    return _h2_client
+
+# Matches playlist URI lines: non-empty lines that are not #-tags/comments
+# (a trailing \r is left in place so CRLF playlists keep their line endings)
+_URI_LINE_RE = re.compile(r'^[ \t]*([^#\s][^\r\n]*?)[ \t]*(?=\r?$)', re.MULTILINE)
+
+# Accepts http(s) URLs with a non-empty host; cheaper than urlparse per request
+_URL_OK = re.compile(r'^https?://[^\s/?#]+', re.IGNORECASE).match
+
+# '.m3u8' (any case) at the end of the path, optionally followed by a query
+_HLS_SUFFIX = re.compile(r'\.m3u8(?:\?|$)', re.IGNORECASE).search
+
+# Open-ended client byte range ('bytes=N-'), capped at MAX_RESPONSE_BYTES
+_OPEN_RANGE_RE = re.compile(r'bytes=(\d+)-')
+
+# Characters that would break a URL embedded as our ?url= query value; the
+# rest of an absolute http(s) URL can be passed through as-is
+_URL_PARAM_ESCAPE = str.maketrans({
+    '%': '%25', '?': '%3F', '#': '%23', '&': '%26', '+': '%2B', ' ': '%20',
+})
+
+# Tags that only appear in master playlists
+_MASTER_TAG_RE = re.compile(r'#EXT-X-(?:STREAM-INF|MEDIA):').search
+
+# Matches KEY=value pairs in an HLS attribute list (values may be quoted)
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+
+def _open_ffprobe_cache():
+    """
+    Open the on-disk ffprobe cache, or return None. diskcache unpickles
+    stored values, so the directory must be private to this user (0700,
+    owned by us); anything else is refused rather than trusted.
+    """
+    if diskcache is None:
+        return None
+    try:
+        os.makedirs(FFPROBE_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.stat(FFPROBE_CACHE_DIR)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            logger.warning("Not using ffprobe cache dir %s: must be owned by this user with mode 0700",
+                           FFPROBE_CACHE_DIR)
+            return None
+        return diskcache.Cache(FFPROBE_CACHE_DIR, size_limit=2 ** 30)
+    except OSError as e:
+        logger.warning("ffprobe disk cache disabled: %s", e)
+        return None
+
+
+# On-disk ffprobe cache shared by all worker processes and kept across restarts;
+# without diskcache, fall back to a per-process in-memory cache with the same TTL
+_FFPROBE_CACHE = _open_ffprobe_cache()
+_FFPROBE_MEM_CACHE = (
+    cachetools.TTLCache(maxsize=FFPROBE_CACHE_SIZE, ttl=FFPROBE_CACHE_TTL)
+    if cachetools and _FFPROBE_CACHE is None else None
+)
+_ffprobe_mem_lock = threading.Lock()
+
+# Fetched playlists (url -> {'text', 'content_type', 'parsed'}). Only master
+# and finished (VOD) playlists are stored; live media playlists change.
+_PL_CACHE = cachetools.TTLCache(maxsize=1024, ttl=PLAYLIST_CACHE_TTL) if cachetools else None
+_pl_cache_lock = threading.Lock()
+
+# Runs ffprobe alongside the HEAD request in /api/validate
+VALIDATE_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix='validate')
+
+# HLS segment prefetching: playlist rewrites warm an in-memory LRU cache
+# (url -> (content, content_type)) so segment requests are served from RAM.
+PREFETCH_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hls-prefetch')
+SEGMENT_CACHE = OrderedDict()
+_segment_cache_lock = threading.Lock()
+_segment_cache_bytes = 0
+_prefetching = set()
+
+
+def json_response(data):
+    """Build a JSON response, serialising with orjson when it is installed."""
+    if orjson is None:
+        return jsonify(data)
+    return Response(orjson.dumps(data), mimetype='application/json')
 
 
 def is_valid_url(url):
-    """Validate URL format and scheme."""
-    if not url:
-        return False
+    """Validate URL format and scheme (http/https with a host)."""
+    return bool(url) and _URL_OK(url) is not None
+
+
+def _capped_range():
+    """
+    Return the (start, end) window an open-ended client Range is capped to,
+    or None when the client sent no range or an explicit end.
+    """
+    match = _OPEN_RANGE_RE.fullmatch(request.headers.get('Range', '').strip())
+    if not match:
+        return None
+    start = int(match.group(1))
+    return start, start + MAX_RESPONSE_BYTES - 1
+
+
+def _build_upstream_headers(cap_range=True):
+    """
+    Build headers for an upstream request from the incoming client request.
+    Forwards Range/If-Range and asks for the raw (identity) body so byte
+    offsets match the file. With cap_range, an open-ended 'bytes=N-' range
+    is closed at MAX_RESPONSE_BYTES so one response can't monopolise the
+    browser's connection to this host.
+    """
+    headers = {'Accept-Encoding': 'identity'}
+    range_header = request.headers.get('Range')
+    if range_header:
+        capped = _capped_range() if cap_range else None
+        if capped:
+            range_header = 'bytes=%d-%d' % capped
+        headers['Range'] = range_header
+        logger.info("Range request: %s", range_header)
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        headers['If-Range'] = if_range
+    return headers
+
+
+def _iter_raw(resp, limit=None):
+    """
+    Yield the upstream body straight from urllib3, skipping requests'
+    iter_content wrapper and content decoding (we ask for identity).
+    Each read() fills a whole CHUNK_SIZE block rather than returning
+    whatever single socket read produced. Stops after `limit` bytes.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        chunk = resp.raw.read(size, decode_content=False)
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+def _parse_rate(rate):
+    """Parse an ffprobe frame rate fraction such as '30000/1001'."""
+    num, _, den = rate.partition('/')
     try:
-        parsed = urlparse(url)
-        return parsed.scheme in ('http', 'https') and parsed.netloc
-    except Exception as e:
-        logger.warning(f"URL validation error: {e}")
-        return False
+        den = int(den or 1)
+        return int(num) / den if den else 0.0
+    except ValueError:
+        return 0.0
 
 
 def is_hls_url(url):
-    """Check if URL is an HLS (.m3u8) stream."""
-    return url.lower().endswith('.m3u8')
+    """Check if URL is an HLS (.m3u8) stream, with or without a query string."""
+    return _HLS_SUFFIX(url) is not None
+
+
+def _cache_segment(url, content, content_type):
+    """Store a segment in the LRU cache, evicting old entries over budget."""
+    global _segment_cache_bytes
+    if len(content) > SEGMENT_CACHE_BYTES:
+        return
+    with _segment_cache_lock:
+        previous = SEGMENT_CACHE.pop(url, None)
+        if previous:
+            _segment_cache_bytes -= len(previous[0])
+        SEGMENT_CACHE[url] = (content, content_type)
+        _segment_cache_bytes += len(content)
+        while _segment_cache_bytes > SEGMENT_CACHE_BYTES:
+            _, (evicted, _) = SEGMENT_CACHE.popitem(last=False)
+            _segment_cache_bytes -= len(evicted)
+
+
+def _get_cached_segment(url):
+    """Return (content, content_type) for a cached segment, or None."""
+    with _segment_cache_lock:
+        entry = SEGMENT_CACHE.get(url)
+        if entry:
+            SEGMENT_CACHE.move_to_end(url)
+        return entry
+
+
+def _read_prefetch_body(status_code, headers, chunks):
+    """
+    Collect a prefetched segment body, or return None if it isn't a 200 or
+    would exceed PREFETCH_MAX_SEGMENT_BYTES (checked against Content-Length
+    first, then while reading, so oversized files are abandoned early).
+    """
+    if status_code != 200:
+        return None
+    limit = min(PREFETCH_MAX_SEGMENT_BYTES, SEGMENT_CACHE_BYTES)
+    declared = headers.get('Content-Length', '')
+    if declared.isdigit() and int(declared) > limit:
+        return None
+    body = bytearray()
+    for chunk in chunks:
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+def _fetch_to_cache(url):
+    """Download a whole segment into the cache (runs on PREFETCH_POOL)."""
+    try:
+        client = _get_h2_client()
+        if client is not None:
+            with client.stream('GET', url) as resp:
+                content = _read_prefetch_body(resp.status_code, resp.headers, resp.iter_bytes(CHUNK_SIZE))
+                content_type = resp.headers.get('Content-Type', 'video/mp2t')
+        else:
+            resp = _get_session().get(url, timeout=REQUEST_TIMEOUT, allow_redirects=True, stream=True)
+            try:
+                content = _read_prefetch_body(resp.status_code, resp.headers, resp.iter_content(CHUNK_SIZE))
+                content_type = resp.headers.get('Content-Type', 'video/mp2t')
+            finally:
+                resp.close()
+        if content is not None:
+            _cache_segment(url, content, content_type)
+        else:
+            logger.info("Segment prefetch skipped for %s", url)
+    except Exception as e:
+        # Best effort: the segment is fetched normally when requested
+        logger.warning("Segment prefetch failed for %s: %s", url, e)
+    finally:
+        with _segment_cache_lock:
+            _prefetching.discard(url)
+
+
+def prefetch_segments(urls):
+    """Queue the first PREFETCH_SEGMENTS not-yet-cached segment URLs for download."""
+    queued = 0
+    for url in urls:
+        if queued >= PREFETCH_SEGMENTS:
+            break
+        with _segment_cache_lock:
+            if url in SEGMENT_CACHE or url in _prefetching:
+                continue
+            _prefetching.add(url)
+        PREFETCH_POOL.submit(_fetch_to_cache, url)
+        queued += 1
+
+
+def _ffprobe_cache_get(url):
+    """Return cached ffprobe output for a URL, or None."""
+    if _FFPROBE_CACHE is not None:
+        return _FFPROBE_CACHE.get(url)
+    if _FFPROBE_MEM_CACHE is not None:
+        with _ffprobe_mem_lock:
+            return _FFPROBE_MEM_CACHE.get(url)
+    return None
+
+
+def _ffprobe_cache_set(url, output):
+    """Cache ffprobe output for FFPROBE_CACHE_TTL seconds."""
+    if _FFPROBE_CACHE is not None:
+        _FFPROBE_CACHE.set(url, output, expire=FFPROBE_CACHE_TTL)
+    elif _FFPROBE_MEM_CACHE is not None:
+        with _ffprobe_mem_lock:
+            _FFPROBE_MEM_CACHE[url] = output
+
+
+def _ffprobe_json(url):
+    """
+    Run ffprobe against a URL and return its raw JSON output (bytes).
+    Cached per URL for FFPROBE_CACHE_TTL, on disk when diskcache is
+    installed; failures raise and are therefore not cached.
+    """
+    cached = _ffprobe_cache_get(url)
+    if cached is not None:
+        return cached
+    
+    cmd = [
+        'ffprobe', '-v', 'quiet', '-threads', '0', '-print_format', 'json',
+        '-show_format', '-show_streams', url,
+    ]
+    # Raw bytes: no newline translation/decoding, json parsers take bytes directly
+    result = subprocess.run(cmd, capture_output=True, timeout=10)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd, stderr=result.stderr)
+    
+    _ffprobe_cache_set(url, result.stdout)
+    return result.stdout
 
 
 def get_ffprobe_info(url):
@@ -61,91 +448,143 @@ def get_ffprobe_info(url):
     Returns: {streams: [...], format: {...}}
     """
     try:
-        # Check if ffprobe is available
-        result = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', url],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode == 0:
-            return json.loads(result.stdout)
-        else:
-            logger.warning(f"ffprobe error for {url}: {result.stderr}")
-            return None
+        # Decode on every call so callers never share a cached dict
+        raw = _ffprobe_json(url)
+        return orjson.loads(raw) if orjson else json.loads(raw)
+    except subprocess.CalledProcessError as e:
+        logger.warning("ffprobe error for %s: %s", url, e.stderr.decode(errors='replace'))
+        return None
     except FileNotFoundError:
         logger.warning("ffprobe not found. Install ffmpeg to enable metadata detection.")
         return None
     except Exception as e:
-        logger.warning(f"ffprobe exception: {e}")
+        logger.warning("ffprobe exception: %s", e)
         return None
 
 
+def _parse_attrs(attr_list):
+    """Parse an HLS attribute list ('BANDWIDTH=800000,AUDIO="aud"') into a dict."""
+    return {key: value.strip('"') for key, value in _ATTR_RE.findall(attr_list)}
+
+
+def _parse_resolution(value):
+    """Parse a RESOLUTION attribute ('1280x720') into a (width, height) tuple."""
+    try:
+        width, height = value.split('x')
+        return int(width), int(height)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _parse_master(text, base_url):
+    """
+    Extract variants, audio tracks and subtitles from playlist text
+    in a single pass over its lines.
+    """
+    variants = []
+    audio_tracks = []
+    subtitles = []
+    stream_inf = None  # Attributes of a #EXT-X-STREAM-INF awaiting its URI line
+    
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            stream_inf = _parse_attrs(line[len('#EXT-X-STREAM-INF:'):])
+        elif line.startswith('#EXT-X-MEDIA:'):
+            attrs = _parse_attrs(line[len('#EXT-X-MEDIA:'):])
+            media_type = attrs.get('TYPE')
+            if media_type not in ('AUDIO', 'SUBTITLES'):
+                continue
+            track = {
+                'language': attrs.get('LANGUAGE'),
+                'name': attrs.get('NAME'),
+                'uri': urljoin(base_url, attrs['URI']) if attrs.get('URI') else None,
+            }
+            if media_type == 'AUDIO':
+                track['group_id'] = attrs.get('GROUP-ID')
+                audio_tracks.append(track)
+            else:
+                subtitles.append(track)
+        elif stream_inf is not None and not line.startswith('#'):
+            bandwidth = stream_inf.get('BANDWIDTH')
+            variants.append({
+                'url': urljoin(base_url, line),
+                'bandwidth': int(bandwidth) if bandwidth and bandwidth.isdigit() else None,
+                'resolution': _parse_resolution(stream_inf.get('RESOLUTION')),
+                'audio': stream_inf.get('AUDIO'),  # Audio group ID
+            })
+            stream_inf = None
+    
+    # Sort variants by bandwidth
+    variants.sort(key=lambda v: v.get('bandwidth', 0) or 0, reverse=True)
+    
+    return {
+        'variants': variants,
+        'audio_tracks': audio_tracks,
+        'subtitles': subtitles,
+        'is_master': len(variants) > 0,
+        'master_url': base_url,
+    }
+
+
+def _get_cached_playlist(url):
+    """Return the cached playlist entry for a URL, or None."""
+    if _PL_CACHE is None:
+        return None
+    with _pl_cache_lock:
+        return _PL_CACHE.get(url)
+
+
+def _remember_playlist(url, response):
+    """
+    Parse a fetched playlist response, caching it if it is a complete (200)
+    master or VOD playlist. Partial bodies are never cached.
+    """
+    text = response.text
+    content_type = response.headers.get('Content-Type', 'application/vnd.apple.mpegurl')
+    entry = {
+        'text': text,
+        'content_type': content_type,
+        # Only master playlists need the per-line parse; media playlists
+        # (e.g. every live reload) get an empty, non-master result
+        'parsed': _parse_master(text, url) if _MASTER_TAG_RE(text) else {
+            'variants': [],
+            'audio_tracks': [],
+            'subtitles': [],
+            'is_master': False,
+            'master_url': url,
+        },
+    }
+    cacheable = entry['parsed']['is_master'] or '#EXT-X-ENDLIST' in text
+    if _PL_CACHE is not None and response.status_code == 200 and cacheable:
+        with _pl_cache_lock:
+            _PL_CACHE[url] = entry
+    return entry
+
+
+def _fetch_playlist(url):
+    """Return {'text', 'content_type', 'parsed'} for a playlist, from cache if possible."""
+    entry = _get_cached_playlist(url)
+    if entry:
+        return entry
+    response = _get_session().get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return _remember_playlist(url, response)
+
+
 def parse_hls_playlist(url):
     """
     Parse HLS (.m3u8) playlist and extract variants.
     Returns: {variants: [...], audio_tracks: [...], subtitles: [...]}
     """
-    if not m3u8:
-        logger.warning("m3u8 library not available")
-        return None
-    
     try:
-        response = requests.get(url, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        
-        playlist = m3u8.loads(response.text)
-        
-        variants = []
-        audio_tracks = []
-        subtitles = []
-        
-        # Extract variants (different quality levels)
-        if playlist.playlists:
-            for variant in playlist.playlists:
-                info = {
-                    'url': urljoin(url, variant.uri),
-                    'bandwidth': variant.stream_info.bandwidth,
-                    'resolution': variant.stream_info.resolution,
-                    'audio': variant.stream_info.audio,  # Audio group ID
-                }
-                variants.append(info)
-        
-        # Extract audio tracks (media playlists)
-        if hasattr(playlist, 'media'):
-            for media in playlist.media:
-                if media.type == 'AUDIO':
-                    audio_tracks.append({
-                        'language': media.language,
-                        'name': media.name,
-                        'uri': urljoin(url, media.uri) if media.uri else None,
-                        'group_id': media.group_id,
-                    })
-        
-        # Extract subtitle tracks
-        if hasattr(playlist, 'media'):
-            for media in playlist.media:
-                if media.type == 'SUBTITLES':
-                    subtitles.append({
-                        'language': media.language,
-                        'name': media.name,
-                        'uri': urljoin(url, media.uri) if media.uri else None,
-                    })
-        
-        # Sort variants by bandwidth
-        variants.sort(key=lambda v: v.get('bandwidth', 0) or 0, reverse=True)
-        
-        return {
-            'variants': variants,
-            'audio_tracks': audio_tracks,
-            'subtitles': subtitles,
-            'is_master': len(variants) > 0,
-            'master_url': url,
-        }
+        return _fetch_playlist(url)['parsed']
     
     except Exception as e:
-        logger.error(f"HLS parsing error for {url}: {e}")
+        logger.error("HLS parsing error for %s: %s", url, e)
         return None
 
 
@@ -161,7 +600,7 @@ def validate():
     url = request.args.get('url', '').strip()
     
     if not is_valid_url(url):
-        return jsonify({'valid': False, 'error': 'Invalid URL format'}), 400
+        return json_response({'valid': False, 'error': 'Invalid URL format'}), 400
     
     is_hls = is_hls_url(url)
     
@@ -170,7 +609,7 @@ def validate():
         if is_hls:
             hls_info = parse_hls_playlist(url)
             if hls_info:
-                return jsonify({
+                return json_response({
                     'valid': True,
                     'type': 'hls',
                     'variants': hls_info['variants'],
@@ -178,13 +617,15 @@ def validate():
                     'is_master': hls_info['is_master']
                 })
             else:
-                return jsonify({'valid': False, 'error': 'Failed to parse HLS playlist'}), 400
+                return json_response({'valid': False, 'error': 'Failed to parse HLS playlist'}), 400
         
-        # For direct streams (MP4, WebM, etc.)
-        resp = requests.head(url, timeout=REQUEST_TIMEOUT, allow_redirects=True)
+        # For direct streams (MP4, WebM, etc.): run the HEAD check and
+        # ffprobe concurrently, since both wait on the remote server
+        probe_future = VALIDATE_POOL.submit(get_ffprobe_info, url)
+        resp = _get_session().head(url, timeout=REQUEST_TIMEOUT, allow_redirects=True)
         
         if resp.status_code not in (200, 206):
-            return jsonify({
+            return json_response({
                 'valid': False,
                 'error': f'Server returned {resp.status_code}'
             }), 400
@@ -202,8 +643,8 @@ def validate():
             'supports_range': accept_ranges == 'bytes'
         }
         
-        # Try to get detailed metadata with ffprobe
-        ffprobe_data = get_ffprobe_info(url)
+        # Detailed metadata from ffprobe (started alongside the HEAD request)
+        ffprobe_data = probe_future.result()
         if ffprobe_data:
             streams = ffprobe_data.get('streams', [])
             
@@ -218,7 +659,7 @@ def validate():
                     'height': v.get('height'),
                     'codec': v.get('codec_name'),
                     'bitrate': v.get('bit_rate'),
-                    'fps': eval(v.get('r_frame_rate', '0/1')),
+                    'fps': _parse_rate(v.get('r_frame_rate') or '0/1'),
                 })
             
             audios = []
@@ -235,11 +676,11 @@ def validate():
             if audios:
                 result['audio_streams'] = audios
         
-        return jsonify(result)
+        return json_response(result)
     
     except requests.RequestException as e:
-        logger.error(f"Validation error for {url}: {e}")
-        return jsonify({'valid': False, 'error': str(e)}), 502
+        logger.error("Validation error for %s: %s", url, e)
+        return json_response({'valid': False, 'error': str(e)}), 502
 
 
 @app.route('/stream')
@@ -250,10 +691,10 @@ def stream():
     
     # Validate URL
     if not is_valid_url(url):
-        logger.warning(f"Invalid URL attempt: {url}")
+        logger.warning("Invalid URL attempt: %s", url)
         abort(400, 'Invalid or missing URL')
     
-    logger.info(f"Stream request for: {url}")
+    logger.info("Stream request for: %s", url)
     
     # Handle HLS streams
     if is_hls_url(url):
@@ -270,10 +711,10 @@ def download():
     
     # Validate URL
     if not is_valid_url(url):
-        logger.warning(f"Invalid download URL attempt: {url}")
+        logger.warning("Invalid download URL attempt: %s", url)
         abort(400, 'Invalid or missing URL')
     
-    logger.info(f"Download request for: {url}")
+    logger.info("Download request for: %s", url)
     
     # Don't allow HLS downloads (too complex, would need to merge segments)
     if is_hls_url(url):
@@ -281,8 +722,9 @@ def download():
     
     try:
         # Fetch the file with streaming enabled
-        response = requests.get(
+        response = _get_session().get(
             url,
+            headers=_build_upstream_headers(cap_range=False),
             stream=True,
             timeout=REQUEST_TIMEOUT,
             allow_redirects=True
@@ -295,13 +737,12 @@ def download():
         try:
             content_length = int(response.headers.get('Content-Length', 0))
             if content_length > MAX_FILE_SIZE:
-                logger.warning(f"Download file too large: {content_length} bytes")
+                logger.warning("Download file too large: %s bytes", content_length)
                 abort(413, 'File too large to download')
         except (ValueError, TypeError):
             pass
         
         # Extract filename from URL or use default
-        from urllib.parse import urlparse
         parsed_url = urlparse(url)
         filename = parsed_url.path.split('/')[-1]
         if not filename or '.' not in filename:
@@ -311,48 +752,63 @@ def download():
         headers = {
             'Content-Type': response.headers.get('Content-Type', 'video/mp4'),
             'Content-Disposition': f'attachment; filename="{filename}"',
+            'Accept-Ranges': 'bytes',
             'Cache-Control': 'no-cache',
         }
         
-        if 'Content-Length' in response.headers:
-            headers['Content-Length'] = response.headers['Content-Length']
+        # Forward length/range so resumed downloads get 206 partial content
+        for header in ['Content-Length', 'Content-Range']:
+            if header in response.headers:
+                headers[header] = response.headers[header]
         
         def generate_download():
             """Generator to yield chunks for download."""
             try:
                 chunk_count = 0
-                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                    if chunk:
-                        chunk_count += 1
-                        yield chunk
-                logger.info(f"Successfully downloaded {chunk_count} chunks of {filename}")
+                for chunk in _iter_raw(response):
+                    chunk_count += 1
+                    yield chunk
+                logger.info("Successfully downloaded %s chunks of %s", chunk_count, filename)
             except Exception as e:
-                logger.error(f"Error during download: {e}")
+                logger.error("Error during download: %s", e)
             finally:
                 response.close()
         
-        return Response(generate_download(), headers=headers)
+        return Response(
+            generate_download(),
+            status=response.status_code,
+            headers=headers,
+            direct_passthrough=True
+        )
     
     except requests.Timeout:
-        logger.error(f"Download timeout for {url}")
+        logger.error("Download timeout for %s", url)
         abort(504, 'Download source timeout')
     except requests.RequestException as e:
-        logger.error(f"Download error for {url}: {e}")
+        logger.error("Download error for %s: %s", url, e)
         abort(502, 'Cannot reach download source')
 
 
 def stream_direct(url):
     """Stream direct video file (MP4, WebM, etc.)."""
+    # HLS segments arrive here; serve prefetched ones straight from memory
+    if 'Range' not in request.headers:
+        cached = _get_cached_segment(url)
+        if cached:
+            content, content_type = cached
+            return Response(content, status=200, headers={
+                'Content-Type': content_type,
+                'Content-Length': str(len(content)),
+                'Accept-Ranges': 'bytes',
+                'Cache-Control': 'no-cache',  # same as an uncached response below
+            })
+    
     # Prepare headers for upstream request
-    upstream_headers = {}
-    range_header = request.headers.get('Range')
-    if range_header:
-        upstream_headers['Range'] = range_header
-        logger.info(f"Range request: {range_header}")
+    upstream_headers = _build_upstream_headers()
     
     try:
         # Fetch from upstream with streaming enabled
-        upstream_resp = requests.get(
+        upstream_resp = _get_session().get(
             url,
             headers=upstream_headers,
             stream=True,
@@ -361,17 +817,18 @@ def stream_direct(url):
         )
         
     except requests.Timeout:
-        logger.error(f"Timeout streaming from {url}")
+        logger.error("Timeout streaming from %s", url)
         abort(504, 'Upstream server timeout')
     except requests.RequestException as e:
-        logger.error(f"Upstream error for {url}: {e}")
+        logger.error("Upstream error for %s: %s", url, e)
         abort(502, f'Cannot reach video source')
     
     # Check Content-Length doesn't exceed limit
+    content_length = 0
     try:
         content_length = int(upstream_resp.headers.get('Content-Length', 0))
         if content_length > MAX_FILE_SIZE:
-            logger.warning(f"File too large: {content_length} bytes")
+            logger.warning("File too large: %s bytes", content_length)
             abort(413, 'File too large')
     except (ValueError, TypeError):
         pass
@@ -391,46 +848,111 @@ def stream_direct(url):
     # Determine response status code
     status_code = upstream_resp.status_code if upstream_resp.status_code in (200, 206) else 200
     
+    # Upstream ignored our capped 'bytes=0-' range and sent the whole file:
+    # cut it down to the same window ourselves so the response stays bounded
+    body_limit = None
+    capped = _capped_range()
+    if capped and capped[0] == 0 and upstream_resp.status_code == 200 and content_length:
+        end = min(capped[1], content_length - 1)
+        body_limit = end + 1
+        status_code = 206
+        response_headers['Content-Range'] = f'bytes 0-{end}/{content_length}'
+        response_headers['Content-Length'] = str(body_limit)
+    
     def generate_chunks():
         """Generator to yield chunks from upstream."""
         try:
             chunk_count = 0
-            for chunk in upstream_resp.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    chunk_count += 1
-                    yield chunk
-            logger.info(f"Successfully streamed {chunk_count} chunks")
+            for chunk in _iter_raw(upstream_resp, body_limit):
+                chunk_count += 1
+                yield chunk
+            logger.info("Successfully streamed %s chunks", chunk_count)
         except Exception as e:
-            logger.error(f"Error during streaming: {e}")
+            logger.error("Error during streaming: %s", e)
         finally:
             upstream_resp.close()
     
-    return Response(generate_chunks(), status=status_code, headers=response_headers)
+    return Response(
+        generate_chunks(),
+        status=status_code,
+        headers=response_headers,
+        direct_passthrough=True
+    )
+
+
+def _playlist_response(url, playlist_content, content_type):
+    """Rewrite a media playlist's URIs to go through /stream and return it."""
+    # Rewrite relative URLs to absolute, proxied URLs
+    segment_urls = []
+    
+    def proxy_uri(match):
+        full_url = urljoin(url, match.group(1))
+        if not is_hls_url(full_url):
+            segment_urls.append(full_url)
+        # Proxy through our /stream endpoint
+        return f"/stream?url={full_url.translate(_URL_PARAM_ESCAPE)}"
+    
+    playlist_content = _URI_LINE_RE.sub(proxy_uri, playlist_content)
+    
+    # Only VOD playlists: a live reload's first segments sit behind the live
+    # edge and were already fetched by the player, so prefetching them would
+    # just download them from the origin a second time
+    if '#EXT-X-ENDLIST' in playlist_content:
+        prefetch_segments(segment_urls)
+    
+    return Response(
+        playlist_content,
+        status=200,
+        headers={
+            'Content-Type': content_type,
+            'Cache-Control': 'no-cache',
+        }
+    )
+
+
+def _stream_variant_url(url):
+    """Fetch a variant playlist with a single GET (or from cache) and return it rewritten."""
+    entry = _fetch_playlist(url)
+    return _playlist_response(url, entry['text'], entry['content_type'])
+
+
+def _select_variant(url, entry, quality):
+    """Serve the requested (or best) variant of a master playlist, else the playlist itself."""
+    hls_info = entry['parsed']
+    
+    # If master playlist with variants, return selected variant
+    if hls_info['is_master']:
+        # Get the requested quality or use the highest quality
+        if quality:
+            selected = next((v for v in hls_info['variants'] if str(v.get('bandwidth')) == quality), None)
+        else:
+            selected = hls_info['variants'][0]  # Highest quality by default
+        
+        if selected:
+            return _stream_variant_url(selected['url'])
+    
+    return _playlist_response(url, entry['text'], entry['content_type'])
 
 
 def stream_hls(url, quality=None):
     """Stream HLS playlist or segments."""
     try:
-        # Parse HLS playlist
-        hls_info = parse_hls_playlist(url)
-        if not hls_info:
-            abort(400, 'Failed to parse HLS playlist')
-        
-        # If master playlist with variants, return selected variant
-        if hls_info['is_master'] and hls_info['variants']:
-            # Get the requested quality or use the highest quality
-            if quality:
-                selected = next((v for v in hls_info['variants'] if str(v.get('bandwidth')) == quality), None)
-            else:
-                selected = hls_info['variants'][0]  # Highest quality by default
-            
-            if selected:
-                # Recursively get the variant playlist
-                return stream_hls(selected['url'], None)
+        # Master and VOD playlists seen recently are served without a fetch
+        entry = _get_cached_playlist(url)
+        if entry:
+            return _select_variant(url, entry, quality)
         
-        # Stream the actual .m3u8 playlist or segments
-        # Fetch the playlist/segment
-        resp = requests.get(url, timeout=REQUEST_TIMEOUT, allow_redirects=True, stream=True)
+        # Fetch the playlist/segment once; the same response is parsed,
+        # rewritten or streamed depending on what it turns out to be.
+        # The client's Range is not forwarded: a partial playlist can't be
+        # rewritten, so ranges only apply once this turns out to be a segment.
+        resp = _get_session().get(
+            url,
+            headers={'Accept-Encoding': 'identity'},
+            timeout=REQUEST_TIMEOUT,
+            allow_redirects=True,
+            stream=True
+        )
         
         if resp.status_code not in (200, 206):
             abort(502, f'HLS source returned {resp.status_code}')
@@ -438,76 +960,68 @@ def stream_hls(url, quality=None):
         # For playlist files (.m3u8), rewrite URLs to proxy through our server
         content_type = resp.headers.get('Content-Type', 'application/vnd.apple.mpegurl')
         
-        if 'mpegurl' in content_type or url.endswith('.m3u8'):
-            # Parse and rewrite playlist
-            playlist_content = resp.text
-            
-            # Rewrite relative URLs to absolute, proxied URLs
-            lines = playlist_content.split('\n')
-            rewritten = []
-            
-            for line in lines:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    # This is a URI line
-                    full_url = urljoin(url, line)
-                    # Proxy through our /stream endpoint
-                    proxied_url = f"/stream?url={requests.utils.quote(full_url, safe='')}"
-                    rewritten.append(proxied_url)
-                else:
-                    rewritten.append(line)
-            
-            playlist_content = '\n'.join(rewritten)
-            
-            return Response(
-                playlist_content,
-                status=200,
-                headers={
-                    'Content-Type': content_type,
-                    'Cache-Control': 'no-cache',
-                }
-            )
+        if 'mpegurl' in content_type or is_hls_url(url):
+            entry = _remember_playlist(url, resp)
+            return _select_variant(url, entry, quality)
         else:
-            # Binary segment file (.ts, .m4s, etc.)
+            # Binary segment file (.ts, .m4s, etc.); re-request it with the
+            # client's Range/If-Range if it sent one
+            if 'Range' in request.headers:
+                resp.close()
+                resp = _get_session().get(
+                    url,
+                    headers=_build_upstream_headers(),
+                    timeout=REQUEST_TIMEOUT,
+                    allow_redirects=True,
+                    stream=True
+                )
+                if resp.status_code not in (200, 206):
+                    abort(502, f'HLS source returned {resp.status_code}')
+            
             response_headers = {
                 'Content-Type': content_type,
+                'Accept-Ranges': 'bytes',
                 'Cache-Control': 'max-age=31536000',
             }
             
-            if 'Content-Length' in resp.headers:
-                response_headers['Content-Length'] = resp.headers['Content-Length']
+            for header in ['Content-Length', 'Content-Range']:
+                if header in resp.headers:
+                    response_headers[header] = resp.headers[header]
             
             def generate_hls_chunk():
                 try:
-                    for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
-                        if chunk:
-                            yield chunk
+                    yield from _iter_raw(resp)
                 except Exception as e:
-                    logger.error(f"Error streaming HLS segment: {e}")
+                    logger.error("Error streaming HLS segment: %s", e)
                 finally:
                     resp.close()
             
-            return Response(generate_hls_chunk(), status=200, headers=response_headers)
+            return Response(
+                generate_hls_chunk(),
+                status=resp.status_code,
+                headers=response_headers,
+                direct_passthrough=True
+            )
     
     except requests.RequestException as e:
-        logger.error(f"HLS streaming error for {url}: {e}")
+        logger.error("HLS streaming error for %s: %s", url, e)
         abort(502, 'Cannot reach HLS source')
 
 
 @app.route('/api/recent')
 def get_recent():
     """Get recently streamed links from localStorage (client-side managed)."""
-    return jsonify({'message': 'Recent links are stored in browser localStorage'})
+    return json_response({'message': 'Recent links are stored in browser localStorage'})
 
 
 @app.errorhandler(400)
 def bad_request(e):
-    return jsonify({'error': str(e.description)}), 400
+    return json_response({'error': str(e.description)}), 400
 
 
 @app.errorhandler(404)
 def not_found(e):
-    return jsonify({'error': 'Not found'}), 404
+    return json_response({'error': 'Not found'}), 404
 
 
 @app.route('/api/get-audio-variant')
@@ -534,7 +1048,7 @@ def get_audio_variant():
                 break
         
         if matching_variant:
-            return jsonify({
+            return json_response({
                 'url': matching_variant['url'],
                 'bandwidth': matching_variant['bandwidth'],
                 'resolution': matching_variant['resolution'],
@@ -542,7 +1056,7 @@ def get_audio_variant():
         else:
             # Fallback to first variant if exact match not found
             if hls_info['variants']:
-                return jsonify({
+                return json_response({
                     'url': hls_info['variants'][0]['url'],
                     'bandwidth': hls_info['variants'][0]['bandwidth'],
                     'resolution': hls_info['variants'][0]['resolution'],
@@ -551,19 +1065,23 @@ def get_audio_variant():
                 abort(400, 'No variants found')
     
     except Exception as e:
-        logger.error(f"Error getting audio variant: {e}")
+        logger.error("Error getting audio variant: %s", e)
         abort(502, 'Error processing audio variant request')
 
 @app.errorhandler(502)
 def bad_gateway(e):
-    return jsonify({'error': 'Cannot reach video source'}), 502
+    return json_response({'error': 'Cannot reach video source'}), 502
 
 
 @app.errorhandler(504)
 def timeout_error(e):
-    return jsonify({'error': 'Video source timeout'}), 504
+    return json_response({'error': 'Video source timeout'}), 504
 
 
 if __name__ == '__main__':
+    # The Werkzeug dev server (debugger + reloader) is for local development
+    # only; production runs under gunicorn (see gunicorn.conf.py)
+    if os.environ.get('DEV') != '1':
+        raise SystemExit("Run with gunicorn (`gunicorn app:app`), or set DEV=1 for the dev server.")
     logger.info("Starting Video Streaming Server")
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,26 @@
+"""
+Gunicorn configuration for the Video Streaming Proxy.
+The proxy is network-bound, so each process runs many threads (gthread)
+and every worker builds its own upstream connection pool after fork.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+worker_class = 'gthread'
+# Every worker has its own HLS segment cache (SEGMENT_CACHE_MB, 256MB by
+# default), prefetch threads and playlist cache, so memory grows with
+# workers x SEGMENT_CACHE_MB. A prefetched segment is also only a hit when
+# the segment request lands on the worker that served the playlist. For
+# HLS-heavy traffic prefer fewer workers with more threads, or lower
+# SEGMENT_CACHE_MB.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('THREADS', 32))
+worker_connections = 1000
+backlog = 2048
+
+# Streams can stay open for a long time; gthread workers heartbeat from the
+# main thread, so this only reaps genuinely stuck workers
+timeout = 120
+keepalive = 5